@@ -1,18 +1,32 @@
 import logging
-from typing import List, Dict, Union
-from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict, Union, Optional, Tuple
 
+import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader
 
 from transformers import (
     AutoTokenizer,
-    AutoModelWithLMHead,
     PreTrainedTokenizer,
     PreTrainedModel,
     T5ForConditionalGeneration,
 )
 
+try:
+    from transformers import AutoModelForSeq2SeqLM
+except ImportError:
+    # Before transformers 3.0 the generic LM head auto class resolves to the same T5/Bart
+    # conditional generation models
+    from transformers import AutoModelWithLMHead as AutoModelForSeq2SeqLM
+
+try:
+    from transformers.modeling_outputs import BaseModelOutput
+except ImportError:
+    # Before transformers 4.0 `generate()` takes encoder outputs as plain tuples
+    BaseModelOutput = None
+
 from tqdm import tqdm
 
 from adaptnlp.model import AdaptiveModel
@@ -20,6 +34,103 @@ from adaptnlp.model import AdaptiveModel
 logger = logging.getLogger(__name__)
 
 
+class _EncoderHiddenStates(torch.nn.Module):
+    """ Returns only an encoder's last hidden states so it exports to a single ONNX output """
+
+    def __init__(self, encoder: torch.nn.Module):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        return self.encoder(input_ids, attention_mask=attention_mask)[0]
+
+
+class _OnnxEncoder(torch.nn.Module):
+    """ Stands in for a transformers encoder by running its exported graph with ONNX Runtime """
+
+    def __init__(self, session, device: torch.device, hidden_size: int):
+        super().__init__()
+        self.session = session
+        self.device = device
+        self.hidden_size = hidden_size
+
+        # With the CUDA provider on the model's own GPU, ONNX Runtime reads and writes torch's buffers
+        # directly instead of round-tripping every batch through host memory
+        self.bind_cuda = False
+        if (
+            device.type == "cuda"
+            and session.get_providers()[0] == "CUDAExecutionProvider"
+        ):
+            cuda_options = session.get_provider_options()["CUDAExecutionProvider"]
+            self.bind_cuda = int(cuda_options.get("device_id", 0)) == device.index
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        **kwargs,
+    ):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        if self.bind_cuda:
+            hidden_states = self._run_on_device(input_ids, attention_mask)
+        else:
+            (hidden_states,) = self.session.run(
+                ["last_hidden_state"],
+                {
+                    "input_ids": input_ids.cpu().numpy(),
+                    "attention_mask": attention_mask.cpu().numpy(),
+                },
+            )
+            hidden_states = torch.from_numpy(hidden_states).to(self.device)
+
+        if BaseModelOutput is not None:
+            return BaseModelOutput(last_hidden_state=hidden_states)
+        return (hidden_states,)
+
+    def _run_on_device(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """ Runs the session with IOBinding on the torch tensors' CUDA buffers """
+        input_ids = input_ids.contiguous()
+        attention_mask = attention_mask.contiguous()
+        hidden_states = torch.empty(
+            (*input_ids.shape, self.hidden_size),
+            dtype=torch.float32,
+            device=self.device,
+        )
+
+        binding = self.session.io_binding()
+        for name, tensor, element_type in [
+            ("input_ids", input_ids, np.int64),
+            ("attention_mask", attention_mask, np.int64),
+        ]:
+            binding.bind_input(
+                name=name,
+                device_type="cuda",
+                device_id=self.device.index,
+                element_type=element_type,
+                shape=tuple(tensor.shape),
+                buffer_ptr=tensor.data_ptr(),
+            )
+        binding.bind_output(
+            name="last_hidden_state",
+            device_type="cuda",
+            device_id=self.device.index,
+            element_type=np.float32,
+            shape=tuple(hidden_states.shape),
+            buffer_ptr=hidden_states.data_ptr(),
+        )
+
+        # ONNX Runtime runs on its own CUDA stream, so wait for torch's pending copies into the inputs
+        # and for the session to finish writing the outputs
+        binding.synchronize_inputs()
+        self.session.run_with_iobinding(binding)
+        binding.synchronize_outputs()
+        return hidden_states
+
+
 class TransformersTranslator(AdaptiveModel):
     """ Adaptive model for Transformer's Conditional Generation or Language Models (Transformer's T5 and Bart
         conditional generation models have a language modeling head)
@@ -34,33 +145,114 @@ class TransformersTranslator(AdaptiveModel):
 
         * **tokenizer** - A tokenizer object from Huggingface's transformers (TODO)and tokenizers
         * **model** - A transformers Conditional Generation (Bart or T5) or Language model
+        * **mixed_precision** - Run generation under CUDA autocast (bf16 on Ampere and newer, fp16 otherwise). Default to False
+        * **compile_encoder** - Compile the encoder with `torch.compile` (PyTorch 2.0+) to cut per-layer dispatch overhead. Falls back to eager with a warning on older PyTorch. Default to False
+        * **compile_decoder** - Compile the per-step decoder and LM head forward pass with `torch.compile` (PyTorch 2.0+). Falls back to eager with a warning on older PyTorch. Default to False
+        * **quantize** - Apply dynamic int8 quantization to the linear layers when running on CPU. Trades a little accuracy for throughput. Default to False
         """
 
-    def __init__(self, tokenizer: PreTrainedTokenizer, model: PreTrainedModel):
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        model: PreTrainedModel,
+        mixed_precision: bool = False,
+        compile_encoder: bool = False,
+        compile_decoder: bool = False,
+        quantize: bool = False,
+    ):
         # Load up model and tokenizer
         self.tokenizer = tokenizer
         self.model = model
 
-        # Setup cuda and automatic allocation of model
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(self.device)
+        # Setup cuda and automatic allocation of model. Models sharded across GPUs at load time with a
+        # `device_map` are already placed, so inputs just go to the device holding the embeddings
+        if getattr(self.model, "hf_device_map", None):
+            self.device = next(self.model.parameters()).device
+        elif torch.cuda.is_available():
+            # Pin the device index: batches are copied over from a worker thread, which would
+            # otherwise resolve a bare "cuda" to its own current device (always cuda:0)
+            self.device = torch.device("cuda", torch.cuda.current_device())
+            self.model.to(self.device)
+        else:
+            self.device = torch.device("cpu")
+            self.model.to(self.device)
+        self.model.eval()
+
+        # Some checkpoints ship with the decoder's key/value cache disabled, which makes every decoding
+        # step (and every beam) recompute attention over the whole generated prefix
+        self.model.config.use_cache = True
+        if getattr(self.model, "generation_config", None) is not None:
+            self.model.generation_config.use_cache = True
+
+        # Dynamic int8 quantization halves the weight bandwidth of the linear layers, but is CPU only
+        if quantize and self.device.type == "cpu":
+            torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+
+        # Mixed precision only applies on GPU; bf16 avoids the fp16 overflows T5 is prone to
+        self.mixed_precision = mixed_precision and self.device.type == "cuda"
+        if self.mixed_precision and torch.cuda.get_device_capability()[0] >= 8:
+            self.amp_dtype = torch.bfloat16
+        else:
+            self.amp_dtype = torch.float16
+
+        # `generate()` runs the encoder once per batch through `get_encoder()`, so only that lookup is
+        # overridden. Compile with dynamic shapes since inputs are padded per mini-batch
+        if compile_encoder and not hasattr(torch, "compile"):
+            logger.warning(
+                "`compile_encoder` requires PyTorch 2.0+ (`torch.compile`), running the encoder eagerly"
+            )
+        elif compile_encoder:
+            compiled_encoder = torch.compile(self.model.get_encoder(), dynamic=True)
+            self.model.get_encoder = lambda: compiled_encoder
+
+        # Every decoding step calls the model's `forward()` with precomputed encoder outputs, so
+        # compiling it covers the decoder stack and LM head for each generated token
+        if compile_decoder and not hasattr(torch, "compile"):
+            logger.warning(
+                "`compile_decoder` requires PyTorch 2.0+ (`torch.compile`), running the decoder eagerly"
+            )
+        elif compile_decoder:
+            self.model.forward = torch.compile(self.model.forward, dynamic=True)
 
     @classmethod
-    def load(cls, model_name_or_path: str) -> AdaptiveModel:
+    def load(
+        cls,
+        model_name_or_path: str,
+        mixed_precision: bool = False,
+        compile_encoder: bool = False,
+        compile_decoder: bool = False,
+        quantize: bool = False,
+        device_map: Optional[Union[str, Dict[str, int]]] = None,
+    ) -> AdaptiveModel:
         """ Class method for loading and constructing this classifier
 
          * **model_name_or_path** - A key string of one of Transformer's pre-trained translator Model
+         * **mixed_precision** - Run generation under CUDA autocast. Default to False
+         * **compile_encoder** - Compile the encoder with `torch.compile`. Default to False
+         * **compile_decoder** - Compile the per-step decoder forward pass with `torch.compile`. Default to False
+         * **quantize** - Apply dynamic int8 quantization to the linear layers on CPU. Default to False
+         * **device_map** - Shard the model's layers across the visible GPUs (e.g. "auto") for models too large for one device, like t5-3b or t5-11b. Requires transformers>=4.20 with `accelerate`. Default to None
         """
-        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-        model = AutoModelWithLMHead.from_pretrained(model_name_or_path)
-        translator = cls(tokenizer, model)
+        tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
+        model_kwargs = {} if device_map is None else {"device_map": device_map}
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path, **model_kwargs)
+        translator = cls(
+            tokenizer,
+            model,
+            mixed_precision=mixed_precision,
+            compile_encoder=compile_encoder,
+            compile_decoder=compile_decoder,
+            quantize=quantize,
+        )
         return translator
 
     def predict(
         self,
         text: Union[List[str], str],
         t5_prefix: str = "translate English to German",
-        mini_batch_size: int = 32,
+        mini_batch_size: Optional[int] = None,
         num_beams: int = 1,
         min_length: int = 0,
         max_length: int = 128,
@@ -72,86 +264,192 @@ class TransformersTranslator(AdaptiveModel):
 
         * **text** - String, list of strings, sentences, or list of sentences to run inference on
         * **t5_prefix**(Optional) - The pre-appended prefix for the specificied task. Only in use for T5-type models.
-        * **mini_batch_size** - Mini batch size
+        * **mini_batch_size** - Mini batch size. Defaults to 64 on GPU and 32 on CPU; inference holds no gradients or optimizer state, so it can use larger batches than training to keep the GPU saturated
         * **num_beams** - Number of beams for beam search. Must be between 1 and infinity. 1 means no beam search.  Default to 1.
         * **min_length** -  The min length of the sequence to be generated. Default to 0
         * **max_length** - The max length of the sequence to be generated. Between min_length and infinity. Default to 128
         * **early_stopping** - if set to True beam search is stopped when at least num_beams sentences finished per batch.
         * **&ast;&ast;kwargs**(Optional) - Optional arguments for the Transformers `PreTrainedModel.generate()` method
         """
-        with torch.no_grad():
+        # `inference_mode` skips autograd bookkeeping entirely but needs torch>=1.9
+        with getattr(torch, "inference_mode", torch.no_grad)():
+
+            if mini_batch_size is None:
+                mini_batch_size = 64 if self.device.type == "cuda" else 32
 
             # Make all inputs lists
             if isinstance(text, str):
                 text = [text]
 
-            # T5 requires "translate: " precursor text for pre-trained translator
+            # T5 requires "translate: " precursor text for pre-trained translator. Tokenize it once and
+            # prepend the ids to every input rather than re-tokenizing it per sequence
+            prefix_ids = None
             if isinstance(self.model, T5ForConditionalGeneration):
-                text = [f"{t5_prefix}: {t}" for t in text]
+                prefix_ids = self.tokenizer.encode(
+                    f"{t5_prefix}:", add_special_tokens=False
+                )
 
-            dataset = self._tokenize(text)
-            dataloader = DataLoader(dataset, batch_size=mini_batch_size)
+            # Translate each distinct input once, longest first so each mini-batch pads to a similar
+            # length (and any OOM shows up on the first batch). Results are mapped back to every
+            # occurrence in input order at the end
+            unique_text = sorted(dict.fromkeys(text), key=len, reverse=True)
             translations = []
 
-            logger.info(f"Running translator on {len(dataset)} text sequences")
+            logger.info(
+                f"Running translator on {len(unique_text)} unique text sequences"
+                f" ({len(text)} total)"
+            )
             logger.info(f"Batch size = {mini_batch_size}")
-            for batch in tqdm(dataloader, desc="Translating"):
-                self.model.eval()
-                batch = tuple(t.to(self.device) for t in batch)
-
-                if len(batch) == 3:
-                    inputs = {
-                        "input_ids": batch[0],
-                        "attention_masks": batch[1],
-                        "token_type_ids": batch[2],
-                    }
-                else:
-                    inputs = {
-                        "input_ids": batch[0],
-                        "attention_masks": batch[1],
-                    }
-                outputs = self.model.generate(
-                    inputs["input_ids"],
-                    num_beams=num_beams,
-                    min_length=min_length,
-                    max_length=max_length,
-                    early_stopping=early_stopping,
-                    **kwargs,
-                )
+            batch_starts = range(0, len(unique_text), mini_batch_size)
+
+            # Tokenize and stage the next mini-batch on a worker thread while the current one is
+            # generating, so only two batches of input tensors exist at any time
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                next_batch = None
+                if unique_text:
+                    next_batch = executor.submit(
+                        self._tokenize, unique_text[:mini_batch_size], prefix_ids
+                    )
+                for i in tqdm(batch_starts, desc="Translating"):
+                    inputs = next_batch.result()
+                    j = i + mini_batch_size
+                    if j < len(unique_text):
+                        next_batch = executor.submit(
+                            self._tokenize,
+                            unique_text[j : j + mini_batch_size],
+                            prefix_ids,
+                        )
 
-                for o in outputs:
-                    translations.append([
+                    # Only touch autocast when asked for, so the default path doesn't need torch>=1.10
+                    if self.mixed_precision:
+                        precision = torch.autocast(
+                            device_type=self.device.type, dtype=self.amp_dtype
+                        )
+                    else:
+                        precision = nullcontext()
+                    with precision:
+                        outputs = self.model.generate(
+                            input_ids=inputs["input_ids"],
+                            attention_mask=inputs["attention_mask"],
+                            num_beams=num_beams,
+                            min_length=min_length,
+                            max_length=max_length,
+                            early_stopping=early_stopping,
+                            **kwargs,
+                        )
+
+                    decoded = [
                         self.tokenizer.decode(
-                            o, skip_special_tokens=True, clean_up_tokenization_spaces=False,
+                            o,
+                            skip_special_tokens=True,
+                            clean_up_tokenization_spaces=False,
                         )
-                    ].pop())
+                        for o in outputs
+                    ]
+
+                    # `generate()` returns `num_return_sequences` rows per input, so keep each
+                    # input's candidates together
+                    batch_size = inputs["input_ids"].size(0)
+                    per_input = len(decoded) // batch_size
+                    translations.extend(
+                        decoded[k * per_input : (k + 1) * per_input]
+                        for k in range(batch_size)
+                    )
+
+            # Drop the last batch and return cached blocks to the driver so later calls with longer
+            # inputs, or other loaded models, don't fail on a fragmented allocator
+            if self.device.type == "cuda":
+                next_batch = inputs = outputs = None
+                torch.cuda.empty_cache()
+
+            translated = dict(zip(unique_text, translations))
+
+        return [t for source in text for t in translated[source]]
+
+    def to_onnx(
+        self,
+        path: Union[str, Path],
+        providers: Optional[List[Union[str, Tuple[str, Dict]]]] = None,
+    ) -> None:
+        """ Exports the encoder to an ONNX graph and runs it with ONNX Runtime in all later `predict` calls.
+        The decoder stays in PyTorch. Requires the `onnxruntime` (or `onnxruntime-gpu`) package
+
+        * **path** - File path to write the ONNX encoder graph to
+        * **providers** - ONNX Runtime execution providers in priority order. Defaults to CUDA on the model's GPU with CPU as fallback. With the CUDA provider on the model's GPU, batches stay on the device; any other setup copies each batch through host memory
+        """
+        import onnxruntime
+
+        if providers is None:
+            providers = ["CPUExecutionProvider"]
+            if self.device.type == "cuda":
+                providers.insert(
+                    0, ("CUDAExecutionProvider", {"device_id": self.device.index})
+                )
+
+        # Export the eager encoder even if `get_encoder()` was overridden (e.g. by `compile_encoder`).
+        # Batch and sequence axes stay dynamic since inputs are padded per mini-batch
+        encoder = _EncoderHiddenStates(type(self.model).get_encoder(self.model))
+        example = self._tokenize(["Example text"])
+        with torch.no_grad():
+            torch.onnx.export(
+                encoder,
+                (example["input_ids"], example["attention_mask"]),
+                str(path),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    name: {0: "batch", 1: "sequence"}
+                    for name in ["input_ids", "attention_mask", "last_hidden_state"]
+                },
+                opset_version=12,
+            )
+        session = onnxruntime.InferenceSession(str(path), providers=providers)
 
-        return translations
+        onnx_encoder = _OnnxEncoder(session, self.device, self.model.config.d_model)
+        self.model.get_encoder = lambda: onnx_encoder
 
-    def _tokenize(self, text: Union[List[str], str]) -> TensorDataset:
-        """ Batch tokenizes text and produces a `TensorDataset` with text """
+    def _tokenize(
+        self, text: List[str], prefix_ids: Optional[List[int]] = None
+    ) -> Dict[str, torch.Tensor]:
+        """ Batch tokenizes text and produces a dictionary of input tensors on the model's device, padded
+        to the longest sequence in the batch (truncated at 512 tokens). `prefix_ids` are prepended to
+        every sequence
+        """
+        prefix_ids = prefix_ids or []
 
         tokenized_text = self.tokenizer.batch_encode_plus(
-            text,
-            return_tensors="pt",
-            max_length=512,
-            pad_to_max_length=True,
-            add_special_tokens=True,
+            text, max_length=512 - len(prefix_ids), add_special_tokens=True,
         )
+        if prefix_ids:
+            tokenized_text["input_ids"] = [
+                prefix_ids + ids for ids in tokenized_text["input_ids"]
+            ]
+            tokenized_text["attention_mask"] = [
+                [1] * len(prefix_ids) + mask
+                for mask in tokenized_text["attention_mask"]
+            ]
+
+        # Pad to the longest sequence in this batch rather than a fixed length. Neither T5 nor Bart
+        # take `token_type_ids`, so only the ids and attention mask are kept
+        longest = max(len(ids) for ids in tokenized_text["input_ids"])
+        padded_text = {}
+        for k in ["input_ids", "attention_mask"]:
+            pad_value = self.tokenizer.pad_token_id if k == "input_ids" else 0
+            rows = []
+            for seq in tokenized_text[k]:
+                padding = [pad_value] * (longest - len(seq))
+                if self.tokenizer.padding_side == "right":
+                    rows.append(seq + padding)
+                else:
+                    rows.append(padding + seq)
+            padded_text[k] = torch.tensor(rows, dtype=torch.long)
 
-        # Bart doesn't use `token_type_ids`
-        if isinstance(self.model, T5ForConditionalGeneration):
-            dataset = TensorDataset(
-                tokenized_text["input_ids"],
-                tokenized_text["attention_mask"],
-                tokenized_text["token_type_ids"],
-            )
-        else:
-            dataset = TensorDataset(
-                tokenized_text["input_ids"], tokenized_text["attention_mask"],
-            )
+            # Page-locked host memory lets the `non_blocking` copy to the GPU run asynchronously
+            if self.device.type == "cuda":
+                padded_text[k] = padded_text[k].pin_memory()
+            padded_text[k] = padded_text[k].to(self.device, non_blocking=True)
 
-        return dataset
+        return padded_text
 
 
 class EasyTranslator:
@@ -167,14 +465,14 @@ class EasyTranslator:
     """
 
     def __init__(self):
-        self.translators: Dict[AdaptiveModel] = defaultdict(bool)
+        self.translators: Dict[str, TransformersTranslator] = {}
 
     def translate(
         self,
         text: Union[List[str], str],
         model_name_or_path: str = "t5-small",
         t5_prefix: str = "translate English to German",
-        mini_batch_size: int = 32,
+        mini_batch_size: Optional[int] = None,
         num_beams: int = 1,
         min_length: int = 0,
         max_length: int = 128,
@@ -187,19 +485,18 @@ class EasyTranslator:
         * **text** - String, list of strings, sentences, or list of sentences to run inference on
         * **model_name_or_path** - A String model id or path to a pre-trained model repository or custom trained model directory 
         * **t5_prefix**(Optional) - The pre-appended prefix for the specificied task. Only in use for T5-type models.
-        * **mini_batch_size** - Mini batch size
+        * **mini_batch_size** - Mini batch size. Defaults to 64 on GPU and 32 on CPU
         * **num_beams** - Number of beams for beam search. Must be between 1 and infinity. 1 means no beam search.  Default to 1.
         * **min_length** -  The min length of the sequence to be generated. Default to 0
         * **max_length** - The max length of the sequence to be generated. Between min_length and infinity. Default to 128
         * **early_stopping** - if set to True beam search is stopped when at least num_beams sentences finished per batch.
         * **&ast;&ast;kwargs**(Optional) - Optional arguments for the Transformers `PreTrainedModel.generate()` method
         """
-        if not self.translators[model_name_or_path]:
-            self.translators[model_name_or_path] = TransformersTranslator.load(
-                model_name_or_path
-            )
+        translator = self.translators.get(model_name_or_path)
+        if translator is None:
+            translator = TransformersTranslator.load(model_name_or_path)
+            self.translators[model_name_or_path] = translator
 
-        translator = self.translators[model_name_or_path]
         return translator.predict(
             text=text,
             t5_prefix=t5_prefix,
@@ -210,3 +507,12 @@ class EasyTranslator:
             early_stopping=early_stopping,
             **kwargs,
         )
+
+    def unload(self, model_name_or_path: str) -> None:
+        """ Removes a loaded translator and frees its cached GPU memory
+
+        * **model_name_or_path** - The String model id or path the translator was loaded with
+        """
+        self.translators.pop(model_name_or_path, None)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
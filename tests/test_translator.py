@@ -1,6 +1,101 @@
-from adaptnlp import EasyTranslator
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from adaptnlp import EasyTranslator, TransformersTranslator
+
+
+@pytest.fixture(scope="module")
+def translator():
+    return TransformersTranslator.load("t5-small")
 
 
 def test_easy_Translator():
     translator = EasyTranslator()
     translator.translate(text="Testing summarizer")
+    translator.unload("t5-small")
+    assert "t5-small" not in translator.translators
+
+
+def test_t5_prefix_ids_match_prefixed_text():
+    # Tokenizer only: `_tokenize` just needs a tokenizer and a device
+    translator = TransformersTranslator.__new__(TransformersTranslator)
+    translator.tokenizer = AutoTokenizer.from_pretrained("t5-small")
+    translator.device = torch.device("cpu")
+
+    t5_prefix = "translate English to German"
+    text = ["Testing translator", "", "...starts with punctuation", "Hello, world!"]
+    prefix_ids = translator.tokenizer.encode(f"{t5_prefix}:", add_special_tokens=False)
+
+    tokenized_text = translator._tokenize(text, prefix_ids)
+    expected = translator.tokenizer.batch_encode_plus(
+        [f"{t5_prefix}: {t}" for t in text], max_length=512, add_special_tokens=True,
+    )["input_ids"]
+
+    for ids, mask, expected_ids in zip(
+        tokenized_text["input_ids"], tokenized_text["attention_mask"], expected
+    ):
+        assert ids[mask.bool()].tolist() == expected_ids
+
+
+def test_translator_to_onnx(tmp_path):
+    pytest.importorskip("onnxruntime")
+    translator = TransformersTranslator.load("t5-small")
+    text = ["Testing translator", "Machines can speak in many languages."]
+    expected = translator.predict(text=text, num_beams=2)
+
+    translator.to_onnx(tmp_path / "encoder.onnx")
+    assert translator.predict(text=text, num_beams=2) == expected
+
+
+def test_translator_num_return_sequences(translator):
+    text = ["Hello", "Machines can speak in many languages.", "Hello"]
+    kwargs = {"num_beams": 2, "num_return_sequences": 2}
+    translations = translator.predict(text=text, **kwargs)
+
+    # Each input's candidates stay together, in input order
+    assert len(translations) == 6
+    assert translations[2:4] == translator.predict(text=text[1], **kwargs)
+    assert translations[0:2] == translations[4:6] == translator.predict(
+        text=text[0], **kwargs
+    )
+
+
+def test_translator_keeps_input_order(translator):
+    # Neither shortest- nor longest-first, so the length sort has to be undone
+    text = [
+        "Good morning.",
+        "Machines can speak in many languages and translate between them.",
+        "Thank you.",
+        "Machine learning will take over the world very soon.",
+    ]
+    translations = translator.predict(text=text, mini_batch_size=2)
+
+    assert len(set(translations)) == len(text)
+    assert translations == [translator.predict(text=t)[0] for t in text]
+
+
+def test_translator_translates_duplicates_once(translator, monkeypatch):
+    generated_rows = []
+    generate = translator.model.generate
+
+    def counting_generate(*args, **kwargs):
+        generated_rows.append(kwargs["input_ids"].size(0))
+        return generate(*args, **kwargs)
+
+    monkeypatch.setattr(translator.model, "generate", counting_generate)
+
+    text = [
+        "Thank you.",
+        "Machine learning will take over the world very soon.",
+        "Thank you.",
+        "Good morning.",
+        "Machine learning will take over the world very soon.",
+    ]
+    translations = translator.predict(text=text)
+
+    # Only the three distinct inputs reach `generate()`
+    assert sum(generated_rows) == 3
+    monkeypatch.undo()
+    expected = {t: translator.predict(text=t)[0] for t in set(text)}
+    assert translations == [expected[t] for t in text]